@@ -1,21 +1,51 @@
 import argparse
-from datetime import datetime
+from datetime import datetime, timezone as dt_timezone
+from email import message_from_string
 import sys
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 import os
+from urllib.parse import quote
 import aiohttp
+import yarl
 import asyncio
-
-import pytz
+from http_utils import (MAX_ATTEMPTS, MAX_CONNECTIONS_PER_HOST, AdaptiveSemaphore, TokenBucket,
+                        close_session, delete_in_batches, get_session, retry_delay, run)
+try:
+    from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+except ImportError:
+    from backports.zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
 SCOPES = ['https://www.googleapis.com/auth/calendar']
 
+# Calendar API default quota is 600 queries per minute per user
+RATE_LIMIT_REQUESTS = 600
+RATE_LIMIT_PERIOD = 60
+
+# Google recommends at most 50 calls per batch request
+BATCH_URL = yarl.URL('https://www.googleapis.com/batch/calendar/v3')
+BATCH_BOUNDARY = 'calendar_cleaner_batch'
+BATCH_SIZE = 50
+
+
+async def delete_all(cleaner, event_ids):
+    try:
+        await cleaner.delete_events(event_ids)
+    finally:
+        await close_session()
+
+
 class GoogleCalendarCleaner:
     def __init__(self, calendar_name=None):
         self.creds = self.authenticate()
+        self.headers = {
+            'Authorization': f'Bearer {self.creds.token}',
+            'Content-Type': 'application/json'
+        }
+        self._service = None
         self.calendar_id = self.get_calendar_id(calendar_name)
+        self._events_path = f'/calendar/v3/calendars/{quote(self.calendar_id, safe="")}/events/'
 
     def authenticate(self):
         creds = None
@@ -48,43 +78,103 @@ class GoogleCalendarCleaner:
         service = self.build_service()
         events_result = service.events().list(calendarId=self.calendar_id, timeMin=start_time_iso,
                                               timeMax=end_time_iso, maxResults=2500, singleEvents=True,
-                                              orderBy='startTime').execute()
-        events = events_result.get('items', [])
-        print(f"Found {len(events)} events to delete.")
-        return events
+                                              orderBy='startTime', fields='items(id)').execute()
+        event_ids = [event['id'] for event in events_result.get('items', [])]
+        print(f"Found {len(event_ids)} events to delete.")
+        return event_ids
 
     def build_service(self):
-        from googleapiclient.discovery import build
-        return build('calendar', 'v3', credentials=self.creds)
+        if self._service is None:
+            from googleapiclient.discovery import build
+            # Use the discovery document bundled with the client instead of fetching it
+            self._service = build('calendar', 'v3', credentials=self.creds,
+                                  cache_discovery=False, static_discovery=True)
+        return self._service
+
+    def _batch_body(self, event_ids):
+        parts = [
+            f'--{BATCH_BOUNDARY}\r\n'
+            f'Content-Type: application/http\r\n'
+            f'Content-ID: <{i}>\r\n\r\n'
+            f'DELETE {self._events_path}{event_id} HTTP/1.1\r\n\r\n'
+            for i, event_id in enumerate(event_ids)
+        ]
+        return ''.join(parts) + f'--{BATCH_BOUNDARY}--\r\n'
 
-    def get_headers(self):
-        return {
-            'Authorization': f'Bearer {self.creds.token}',
-            'Accept': 'application/json'
-        }
-
-    async def delete_event(self, session, event_id, semaphore):
-        delete_url = f'https://www.googleapis.com/calendar/v3/calendars/{self.calendar_id}/events/{event_id}'
-        async with semaphore:
-            async with session.delete(delete_url, headers=self.get_headers(), ssl=True) as response:
-                if response.status == 204:
+    @staticmethod
+    async def _read_batch_response(response):
+        # Each part wraps a raw HTTP response: status line, headers and body
+        results = {}
+        reader = aiohttp.MultipartReader.from_response(response)
+        while True:
+            part = await reader.next()
+            if part is None:
+                break
+            content_id = part.headers.get('Content-ID', '')
+            status_line, _, rest = (await part.text()).partition('\r\n')
+            try:
+                index = int(content_id.strip('<>').rsplit('-', 1)[-1])
+                status = int(status_line.split()[1])
+            except (ValueError, IndexError):
+                print(f"Skipping unreadable batch response part {content_id!r}: {status_line}")
+                continue
+            results[index] = (status, message_from_string(rest))
+        return results
+
+    async def _delete_batch(self, session, chunk, bucket, limiter):
+        pending = chunk
+        for attempt in range(MAX_ATTEMPTS):
+            headers = {'Content-Type': f'multipart/mixed; boundary={BATCH_BOUNDARY}'}
+            await bucket.acquire(len(pending))
+            async with limiter:
+                async with session.post(BATCH_URL, data=self._batch_body(pending), headers=headers, ssl=True) as response:
+                    if response.status in (429, 503):
+                        results = None
+                        delay = retry_delay(response.headers, attempt)
+                    elif response.status != 200:
+                        print(f"Could not delete batch of {len(pending)} events: {response.status} {await response.text()}")
+                        return
+                    else:
+                        results = await self._read_batch_response(response)
+
+            if results is None:
+                limiter.throttled()
+                await asyncio.sleep(delay)
+                continue
+
+            throttled = []
+            delay = 0
+            unanswered = dict(enumerate(pending))
+            for i, (status, message) in results.items():
+                event_id = unanswered.pop(i, None)
+                if event_id is None:
+                    continue
+                if status == 204:
                     pass
+                elif status in (429, 503):
+                    throttled.append(event_id)
+                    delay = max(delay, retry_delay(message, attempt))
                 else:
-                    print(f"Could not delete event {event_id}: {response.status} {await response.text()}")
-                await asyncio.sleep(0.01)
+                    print(f"Could not delete event {event_id}: {status} {message.get_payload()}")
+            for event_id in unanswered.values():
+                print(f"Could not delete event {event_id}: no response in batch")
+            if not throttled:
+                limiter.succeeded()
+                return
+            limiter.throttled()
+            pending = throttled
+            await asyncio.sleep(delay)
+
+        for event_id in pending:
+            print(f"Could not delete event {event_id}: still throttled after {MAX_ATTEMPTS} attempts")
+
+    async def delete_events(self, event_ids):
+        bucket = TokenBucket(RATE_LIMIT_REQUESTS, RATE_LIMIT_REQUESTS / RATE_LIMIT_PERIOD)
+        limiter = AdaptiveSemaphore(MAX_CONNECTIONS_PER_HOST)
+        session = await get_session(self.headers)
+        await delete_in_batches(event_ids, BATCH_SIZE,
+                                lambda chunk: self._delete_batch(session, chunk, bucket, limiter))
 
-    async def delete_events(self, events):
-        semaphore = asyncio.Semaphore(3)
-        async with aiohttp.ClientSession() as session:
-            tasks = [self.delete_event(session, event['id'], semaphore) for event in events]
-            await asyncio.gather(*tasks)
-
-    def get_headers(self):
-        return {
-            'Authorization': f'Bearer {self.creds.token}',
-            'Content-Type': 'application/json'
-        }
-    
     @staticmethod
     def clean_token_cache():
         os.remove('token.json')
@@ -93,8 +183,8 @@ class GoogleCalendarCleaner:
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Delete Google Calendar events within a specified time range.')
-    parser.add_argument('--start', help='Start time in format YYYY-MM-DD HH:MM')
-    parser.add_argument('--end', help='End time in format YYYY-MM-DD HH:MM')
+    parser.add_argument('--start', help='Start time in format YYYY-MM-DD HH:MM or YYYY-MM-DDTHH:MM')
+    parser.add_argument('--end', help='End time in format YYYY-MM-DD HH:MM or YYYY-MM-DDTHH:MM')
     parser.add_argument('--calendar', required=False, help='Calendar name, default is primary calendar', default='primary')
     parser.add_argument('--clean', action='store_true', help='Clean token cache')
     parser.add_argument('--timezone', required=False, default='Europe/Helsinki', help='Timezone, default is Europe/Helsinki')
@@ -113,16 +203,18 @@ def main():
         sys.exit(1)
 
     try:
-        timezone = pytz.timezone(args.timezone)
-    except pytz.UnknownTimeZoneError:
+        timezone = ZoneInfo(args.timezone)
+    except (ZoneInfoNotFoundError, ValueError, OSError):
         print(f"Unknown timezone: {args.timezone}")
         sys.exit(1)
 
     try:
-        start_time_naive = datetime.strptime(args.start, '%Y-%m-%d %H:%M')
-        end_time_naive = datetime.strptime(args.end, '%Y-%m-%d %H:%M')
-        start_time = timezone.localize(start_time_naive).astimezone(pytz.utc)
-        end_time = timezone.localize(end_time_naive).astimezone(pytz.utc)
+        start_time_naive = datetime.fromisoformat(args.start)
+        end_time_naive = datetime.fromisoformat(args.end)
+        if start_time_naive.tzinfo is not None or end_time_naive.tzinfo is not None:
+            raise ValueError("times must not include a UTC offset, use --timezone instead")
+        start_time = start_time_naive.replace(tzinfo=timezone).astimezone(dt_timezone.utc)
+        end_time = end_time_naive.replace(tzinfo=timezone).astimezone(dt_timezone.utc)
     except ValueError as e:
         print(f"Error parsing times: {e}")
         sys.exit(1)
@@ -131,8 +223,8 @@ def main():
     end_time_iso = end_time.isoformat().replace("+00:00", "Z")
 
     cleaner = GoogleCalendarCleaner(calendar_name=args.calendar)
-    events = cleaner.fetch_events(start_time_iso, end_time_iso)
-    asyncio.run(cleaner.delete_events(events))
+    event_ids = cleaner.fetch_events(start_time_iso, end_time_iso)
+    run(delete_all(cleaner, event_ids))
 
 
 if __name__ == '__main__':
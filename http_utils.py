@@ -0,0 +1,120 @@
+import asyncio
+import sys
+
+import aiohttp
+
+MAX_CONNECTIONS_PER_HOST = 16
+MAX_ATTEMPTS = 5
+
+
+class AdaptiveSemaphore:
+    """Concurrency limit that halves when throttled and grows back by one after a run of successes."""
+
+    def __init__(self, limit, minimum=1, increase_after=10):
+        self.limit = limit
+        self.maximum = limit
+        self.minimum = minimum
+        self.increase_after = increase_after
+        self._in_flight = 0
+        self._successes = 0
+        self._condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._in_flight < self.limit)
+            self._in_flight += 1
+
+    async def __aexit__(self, *exc_info):
+        async with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def throttled(self):
+        self.limit = max(self.minimum, self.limit // 2)
+        self._successes = 0
+
+    def succeeded(self):
+        self._successes += 1
+        if self._successes >= self.increase_after:
+            self.limit = min(self.maximum, self.limit + 1)
+            self._successes = 0
+
+
+class TokenBucket:
+    """Rate limit that allows bursts of up to `capacity` requests and refills at `rate` requests per second."""
+
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self._tokens = capacity
+        self._updated = None
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens=1):
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            while True:
+                now = loop.time()
+                if self._updated is not None:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+
+def retry_delay(headers, attempt):
+    try:
+        return float(headers['Retry-After'])
+    except (KeyError, TypeError, ValueError):
+        return 2 ** attempt * 0.1
+
+
+_session = None
+
+
+async def get_session(headers):
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=32, limit_per_host=MAX_CONNECTIONS_PER_HOST,
+                                         ttl_dns_cache=300, enable_cleanup_closed=True,
+                                         keepalive_timeout=75)
+        _session = aiohttp.ClientSession(connector=connector, headers=headers,
+                                         timeout=aiohttp.ClientTimeout(total=30, connect=10))
+    return _session
+
+
+async def close_session():
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+async def delete_in_batches(event_ids, batch_size, delete_batch, workers=MAX_CONNECTIONS_PER_HOST):
+    queue = asyncio.Queue()
+    for i in range(0, len(event_ids), batch_size):
+        queue.put_nowait(event_ids[i:i + batch_size])
+    for _ in range(workers):
+        queue.put_nowait(None)
+
+    async def worker():
+        while (chunk := await queue.get()) is not None:
+            await delete_batch(chunk)
+
+    await asyncio.gather(*[worker() for _ in range(workers)])
+
+
+def run(coro):
+    """Run `coro` with asyncio.run, on uvloop when it is installed."""
+    if sys.platform != 'win32':
+        try:
+            import uvloop
+        except ImportError:
+            pass
+        else:
+            if sys.version_info >= (3, 12):
+                return asyncio.run(coro, loop_factory=uvloop.new_event_loop)
+            uvloop.install()
+    return asyncio.run(coro)
@@ -1,19 +1,38 @@
 import asyncio
-from time import sleep
-import requests
 import argparse
 import os
 import sys
 import dotenv as dotenv
 import msal
-import pytz
-import json
-from datetime import datetime
+import ijson
+import orjson
+from datetime import datetime, timezone as dt_timezone
+try:
+    from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+except ImportError:
+    from backports.zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 import aiohttp
-import ssl
+import yarl
+from http_utils import (MAX_ATTEMPTS, MAX_CONNECTIONS_PER_HOST, AdaptiveSemaphore, TokenBucket,
+                        close_session, delete_in_batches, get_session, retry_delay, run)
 
 dotenv.load_dotenv()
 
+# Graph allows 10000 requests per 10 minutes per app and mailbox
+RATE_LIMIT_REQUESTS = 10000
+RATE_LIMIT_PERIOD = 600
+
+# Graph accepts at most 20 requests per JSON batch
+BATCH_URL = yarl.URL('https://graph.microsoft.com/v1.0/$batch')
+BATCH_SIZE = 20
+
+async def clean_events(cleaner, start_time_iso, end_time_iso):
+    try:
+        event_ids = await cleaner.fetch_events(start_time_iso, end_time_iso)
+        await cleaner.delete_events(event_ids)
+    finally:
+        await close_session()
+
 class CalendarCleaner:
     def __init__(self, client_id, tenant_id, timezone='Europe/Helsinki'):
         self.client_id = client_id
@@ -35,13 +54,14 @@ class CalendarCleaner:
     def load_cache(self):
         cache = msal.SerializableTokenCache()
         if os.path.exists("token_cache.bin"):
-            cache.deserialize(open("token_cache.bin", "r").read())
+            with open("token_cache.bin", "rb") as f:
+                cache.deserialize(f.read().decode('utf-8'))
         return cache
 
     def save_cache(self):
         if self.cache.has_state_changed:
-            with open("token_cache.bin", "w") as f:
-                f.write(self.cache.serialize())
+            with open("token_cache.bin", "wb") as f:
+                f.write(self.cache.serialize().encode('utf-8'))
 
     @staticmethod
     def clean_cache():
@@ -66,51 +86,112 @@ class CalendarCleaner:
         else:
             raise Exception(f"Could not acquire access token: {result.get('error')}")
 
-    def fetch_events(self, start_time_iso, end_time_iso):
-        events = []
-        next_link = f'https://graph.microsoft.com/v1.0/me/calendarview?startDateTime={start_time_iso}&endDateTime={end_time_iso}&$top=500'
+    async def _fetch_page(self, session, url):
+        print(f"Fetching link: {url}")
+        for attempt in range(MAX_ATTEMPTS):
+            async with session.get(url, headers={'Prefer': 'return=minimal'}, ssl=True) as response:
+                if response.status in (429, 503) and attempt < MAX_ATTEMPTS - 1:
+                    delay = retry_delay(response.headers, attempt)
+                else:
+                    if response.status != 200:
+                        print(await response.text())
+                    response.raise_for_status()
+                    return await self._read_page(response.content)
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    async def _read_page(stream):
+        # Pull only the event ids and the next link out of the byte stream
+        event_ids = []
+        next_link = None
+        async for prefix, event, value in ijson.parse_async(stream):
+            if prefix == 'value.items.id':
+                event_ids.append(value)
+            elif prefix == '@odata.nextLink':
+                next_link = value
+        return event_ids, next_link
+
+    async def fetch_events(self, start_time_iso, end_time_iso):
+        event_ids = []
+        next_link = f'https://graph.microsoft.com/v1.0/me/calendarview?startDateTime={start_time_iso}&endDateTime={end_time_iso}&$top=500&$select=id'
         print("Fetching calendar events...")
 
+        session = await get_session(self.headers)
         while next_link:
-            if len(events) > 9500:
-                print(f"Fetched {len(events)} events, stopping.")
+            if len(event_ids) > 9500:
+                print(f"Fetched {len(event_ids)} events, stopping.")
                 break
             try:
-                print(f"Fetching link: {next_link}")
-                response = requests.get(next_link, headers=self.headers, verify=True)
-                response.raise_for_status()
-                data = response.json()
-                events.extend(data['value'])
-                next_link = data.get('@odata.nextLink')
-                sleep(0.05)
-            except requests.exceptions.HTTPError as err:
+                page_ids, next_link = await self._fetch_page(session, next_link)
+            except aiohttp.ClientResponseError as err:
                 print(f"Error fetching calendar events: {err}")
-                print(response.text)
                 sys.exit(1)
-
-        print(f"Found {len(events)} events to delete.")
-        return events
-
-    async def delete_event(self, session, event_id, semaphore):
-        delete_url = f'https://graph.microsoft.com/v1.0/me/events/{event_id}'
-        async with semaphore:
-            async with session.delete(delete_url, headers=self.headers, ssl=True) as response:
-                if response.status == 204:
+            event_ids.extend(page_ids)
+
+        print(f"Found {len(event_ids)} events to delete.")
+        return event_ids
+
+    async def _delete_batch(self, session, chunk, bucket, limiter):
+        pending = chunk
+        for attempt in range(MAX_ATTEMPTS):
+            payload = {'requests': [
+                {'id': str(i), 'method': 'DELETE', 'url': f'/me/events/{event_id}'}
+                for i, event_id in enumerate(pending)
+            ]}
+            await bucket.acquire(len(pending))
+            async with limiter:
+                async with session.post(BATCH_URL, json=payload, ssl=True) as response:
+                    if response.status in (429, 503):
+                        data = None
+                        delay = retry_delay(response.headers, attempt)
+                    elif response.status != 200:
+                        print(f"Could not delete batch of {len(pending)} events: {response.status} {await response.text()}")
+                        return
+                    else:
+                        data = orjson.loads(await response.read())
+
+            if data is None:
+                limiter.throttled()
+                await asyncio.sleep(delay)
+                continue
+
+            throttled = []
+            delay = 0
+            unanswered = {str(i): event_id for i, event_id in enumerate(pending)}
+            for item in data.get('responses', []):
+                event_id = unanswered.pop(item.get('id'), None)
+                if event_id is None:
+                    continue
+                if item['status'] == 204:
                     print(f"Deleted event {event_id}")
+                elif item['status'] in (429, 503):
+                    throttled.append(event_id)
+                    delay = max(delay, retry_delay(item.get('headers', {}), attempt))
                 else:
-                    print(f"Could not delete event {event_id}: {response.status} {await response.text()}")
-                await asyncio.sleep(0.05)
-
-    async def delete_events(self, events):
-        semaphore = asyncio.Semaphore(3)
-        async with aiohttp.ClientSession() as session:
-            tasks = [self.delete_event(session, event['id'], semaphore) for event in events]
-            await asyncio.gather(*tasks)
+                    print(f"Could not delete event {event_id}: {item['status']} {item.get('body')}")
+            for event_id in unanswered.values():
+                print(f"Could not delete event {event_id}: no response in batch")
+            if not throttled:
+                limiter.succeeded()
+                return
+            limiter.throttled()
+            pending = throttled
+            await asyncio.sleep(delay)
+
+        for event_id in pending:
+            print(f"Could not delete event {event_id}: still throttled after {MAX_ATTEMPTS} attempts")
+
+    async def delete_events(self, event_ids):
+        bucket = TokenBucket(RATE_LIMIT_REQUESTS, RATE_LIMIT_REQUESTS / RATE_LIMIT_PERIOD)
+        limiter = AdaptiveSemaphore(MAX_CONNECTIONS_PER_HOST)
+        session = await get_session(self.headers)
+        await delete_in_batches(event_ids, BATCH_SIZE,
+                                lambda chunk: self._delete_batch(session, chunk, bucket, limiter))
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Delete calendar events within a specified time range.')
-    parser.add_argument('--start', help='Start time in format YYYY-MM-DD HH:MM')
-    parser.add_argument('--end', help='End time in format YYYY-MM-DD HH:MM')
+    parser.add_argument('--start', help='Start time in format YYYY-MM-DD HH:MM or YYYY-MM-DDTHH:MM')
+    parser.add_argument('--end', help='End time in format YYYY-MM-DD HH:MM or YYYY-MM-DDTHH:MM')
     parser.add_argument('--timezone', required=False, default='Europe/Helsinki', help='Timezone, default is Europe/Helsinki')
     parser.add_argument('--clean', action='store_true', help='Clean token cache')
     return parser.parse_args()
@@ -128,16 +209,18 @@ def main():
         sys.exit(0)
 
     try:
-        timezone = pytz.timezone(args.timezone)
-    except pytz.UnknownTimeZoneError:
+        timezone = ZoneInfo(args.timezone)
+    except (ZoneInfoNotFoundError, ValueError, OSError):
         print(f"Unknown timezone: {args.timezone}")
         sys.exit(1)
 
     try:
-        start_time_naive = datetime.strptime(args.start, '%Y-%m-%d %H:%M')
-        end_time_naive = datetime.strptime(args.end, '%Y-%m-%d %H:%M')
-        start_time = timezone.localize(start_time_naive).astimezone(pytz.utc)
-        end_time = timezone.localize(end_time_naive).astimezone(pytz.utc)
+        start_time_naive = datetime.fromisoformat(args.start)
+        end_time_naive = datetime.fromisoformat(args.end)
+        if start_time_naive.tzinfo is not None or end_time_naive.tzinfo is not None:
+            raise ValueError("times must not include a UTC offset, use --timezone instead")
+        start_time = start_time_naive.replace(tzinfo=timezone).astimezone(dt_timezone.utc)
+        end_time = end_time_naive.replace(tzinfo=timezone).astimezone(dt_timezone.utc)
     except ValueError as e:
         print(f"Error parsing times: {e}")
         sys.exit(1)
@@ -149,8 +232,7 @@ def main():
     tenant_id = os.environ.get('TENANT_ID') or input('Enter tenant ID: ')
 
     cleaner = CalendarCleaner(client_id, tenant_id, args.timezone)
-    events = cleaner.fetch_events(start_time_iso, end_time_iso)
-    asyncio.run(cleaner.delete_events(events))
+    run(clean_events(cleaner, start_time_iso, end_time_iso))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,11 +1,12 @@
 # test_cleaner.py
+import io
+import json
 import os
-import sys
 import asyncio
-import aiohttp
 import pytest
-from unittest.mock import patch, MagicMock, mock_open
-from cleaner import CalendarCleaner
+from unittest.mock import patch, MagicMock, AsyncMock, mock_open
+from http_utils import AdaptiveSemaphore, TokenBucket
+from msgraph_cleaner import CalendarCleaner, main
 
 @pytest.fixture
 def cleaner(monkeypatch):
@@ -22,10 +23,10 @@ def cleaner(monkeypatch):
 
 def test_load_cache_exists(cleaner, monkeypatch):
     monkeypatch.setattr(os.path, 'exists', lambda x: True)
-    with patch('builtins.open', mock_open(read_data='{}')) as mock_file:
+    with patch('builtins.open', mock_open(read_data=b'{}')) as mock_file:
         cache = cleaner.load_cache()
         assert cache is not None
-        mock_file.assert_called_once_with('token_cache.bin', 'r')
+        mock_file.assert_called_once_with('token_cache.bin', 'rb')
 
 def test_load_cache_not_exists(cleaner, monkeypatch):
     monkeypatch.setattr(os.path, 'exists', lambda x: False)
@@ -36,7 +37,7 @@ def test_save_cache(cleaner):
     with patch('builtins.open', mock_open()) as mock_file:
         cleaner.cache.has_state_changed = True
         cleaner.save_cache()
-        mock_file.assert_called_once_with('token_cache.bin', 'w')
+        mock_file.assert_called_once_with('token_cache.bin', 'wb')
 
 def test_clean_cache(cleaner, monkeypatch):
     monkeypatch.setattr(os.path, 'exists', lambda x: True)
@@ -55,12 +56,140 @@ def test_acquire_token_device_flow(cleaner, monkeypatch):
         assert token == 'test_token'
         mock_stdout.flush.assert_called_once()
 
+def page_response(ids, next_link=None):
+    response = MagicMock()
+    response.status = 200
+    body = io.BytesIO(json.dumps({'value': [{'id': i} for i in ids], '@odata.nextLink': next_link}).encode())
+    response.content.read = AsyncMock(side_effect=body.read)
+    context = MagicMock()
+    context.__aenter__.return_value = response
+    return context
+
+def run_fetch_events(cleaner, session):
+    with patch('msgraph_cleaner.get_session', AsyncMock(return_value=session)):
+        return asyncio.run(cleaner.fetch_events('2023-01-01T00:00:00Z', '2023-01-02T00:00:00Z'))
+
+def requested_urls(session):
+    return [call.args[0] for call in session.get.call_args_list]
+
+def test_fetch_events_follows_next_links_in_order(cleaner):
+    session = MagicMock()
+    session.get.side_effect = [
+        page_response(['a1', 'a2'], 'https://graph.microsoft.com/v1.0/page2'),
+        page_response(['b1'], 'https://graph.microsoft.com/v1.0/page3'),
+        page_response(['c1', 'c2']),
+    ]
+
+    events = run_fetch_events(cleaner, session)
+
+    assert events == ['a1', 'a2', 'b1', 'c1', 'c2']
+    urls = requested_urls(session)
+    assert urls[0].startswith('https://graph.microsoft.com/v1.0/me/calendarview?')
+    assert urls[1:] == ['https://graph.microsoft.com/v1.0/page2', 'https://graph.microsoft.com/v1.0/page3']
+
+def test_fetch_events_stops_after_9500_events(cleaner, capsys):
+    session = MagicMock()
+    session.get.side_effect = lambda url, **kwargs: page_response(
+        [f'{url}-{i}' for i in range(500)], f'https://graph.microsoft.com/v1.0/page{session.get.call_count + 1}')
+
+    events = run_fetch_events(cleaner, session)
+
+    assert len(events) == 10000
+    assert session.get.call_count == 20
+    assert requested_urls(session)[1:] == [f'https://graph.microsoft.com/v1.0/page{n}' for n in range(2, 21)]
+    assert 'Fetched 10000 events, stopping.' in capsys.readouterr().out
+
 def test_fetch_events(cleaner):
-    with patch('requests.get') as mock_get:
-        mock_response = MagicMock()
-        mock_response.json.return_value = {'value': [], '@odata.nextLink': None}
-        mock_get.return_value = mock_response
-
-        events = cleaner.fetch_events('2023-01-01T00:00:00Z', '2023-01-02T00:00:00Z')
-        assert events == []
-        mock_get.assert_called()
+    first_page = MagicMock()
+    first_page.status = 200
+    body = io.BytesIO(json.dumps({
+        '@odata.context': 'https://graph.microsoft.com/v1.0/$metadata#users/events(id)',
+        'value': [
+            {'id': 'AAMkAD1', 'organizer': {'id': 'not-an-event'}},
+            {'id': 'AAMkAD2'},
+            {'id': 'AAMkAD3'},
+        ],
+        '@odata.nextLink': 'https://graph.microsoft.com/v1.0/me/calendarview?$skiptoken=abc',
+    }).encode())
+    first_page.content.read = AsyncMock(side_effect=body.read)
+    first_context = MagicMock()
+    first_context.__aenter__.return_value = first_page
+    mock_session = MagicMock()
+    mock_session.get.side_effect = [first_context, page_response([])]
+
+    events = run_fetch_events(cleaner, mock_session)
+
+    assert events == ['AAMkAD1', 'AAMkAD2', 'AAMkAD3']
+    assert mock_session.get.call_count == 2
+    assert mock_session.get.call_args_list[1].args[0] == 'https://graph.microsoft.com/v1.0/me/calendarview?$skiptoken=abc'
+
+def batch_response(status, body=None, headers=None):
+    response = MagicMock()
+    response.status = status
+    response.headers = headers or {}
+    response.read = AsyncMock(return_value=json.dumps(body).encode())
+    response.text = AsyncMock(return_value=json.dumps(body))
+    context = MagicMock()
+    context.__aenter__.return_value = response
+    return context
+
+def run_delete_batch(cleaner, session, chunk):
+    async def run():
+        limiter = AdaptiveSemaphore(4)
+        await cleaner._delete_batch(session, chunk, TokenBucket(100, 100), limiter)
+        return limiter
+    return asyncio.run(run())
+
+def sent_urls(call):
+    return [request['url'] for request in call.kwargs['json']['requests']]
+
+def test_delete_batch_resends_only_throttled_events(cleaner, capsys):
+    session = MagicMock()
+    session.post.side_effect = [
+        batch_response(200, {'responses': [
+            {'id': '0', 'status': 204},
+            {'id': '1', 'status': 404, 'body': {'error': 'not found'}},
+            {'id': '2', 'status': 429, 'headers': {'Retry-After': '0'}},
+        ]}),
+        batch_response(200, {'responses': [{'id': '0', 'status': 204}]}),
+    ]
+
+    limiter = run_delete_batch(cleaner, session, ['e0', 'e1', 'e2', 'e3'])
+
+    assert session.post.call_count == 2
+    assert sent_urls(session.post.call_args_list[0]) == [f'/me/events/e{i}' for i in range(4)]
+    assert sent_urls(session.post.call_args_list[1]) == ['/me/events/e2']
+    output = capsys.readouterr().out
+    assert 'Deleted event e0' in output
+    assert 'Could not delete event e1: 404' in output
+    assert 'Deleted event e2' in output
+    assert 'Could not delete event e3: no response in batch' in output
+    assert limiter.limit == 2
+
+def test_delete_batch_retries_whole_batch_on_outer_throttle(cleaner, capsys):
+    session = MagicMock()
+    session.post.side_effect = [
+        batch_response(429, headers={'Retry-After': '0'}),
+        batch_response(200, {'responses': [{'id': '0', 'status': 204}, {'id': '1', 'status': 204}]}),
+    ]
+
+    limiter = run_delete_batch(cleaner, session, ['e0', 'e1'])
+
+    assert session.post.call_count == 2
+    assert sent_urls(session.post.call_args_list[0]) == sent_urls(session.post.call_args_list[1])
+    output = capsys.readouterr().out
+    assert 'Deleted event e0' in output
+    assert 'Deleted event e1' in output
+    assert limiter.limit == 2
+
+@pytest.mark.parametrize('argv, message', [
+    (['--timezone', 'America'], 'Unknown timezone: America'),
+    (['--timezone', 'Nowhere/Town'], 'Unknown timezone: Nowhere/Town'),
+    (['--end', '2024-06-01T12:00+05:00'], 'Error parsing times'),
+])
+def test_main_rejects_bad_time_arguments(argv, message, capsys):
+    args = ['msgraph_cleaner.py', '--start', '2024-06-01 10:00', '--end', '2024-06-01 11:00'] + argv
+    with patch('sys.argv', args), pytest.raises(SystemExit) as exit_info:
+        main()
+    assert exit_info.value.code == 1
+    assert message in capsys.readouterr().out
@@ -0,0 +1,74 @@
+# test_google_cleaner.py
+import asyncio
+import aiohttp
+import pytest
+from multidict import CIMultiDict
+from unittest.mock import patch, MagicMock, AsyncMock
+from http_utils import AdaptiveSemaphore, TokenBucket
+from google_cleaner import GoogleCalendarCleaner
+
+BOUNDARY = 'batch_response'
+
+@pytest.fixture
+def cleaner():
+    with patch.object(GoogleCalendarCleaner, 'authenticate', return_value=MagicMock(token='test_token')), \
+         patch.object(GoogleCalendarCleaner, 'get_calendar_id', return_value='team@group.calendar.google.com'):
+        return GoogleCalendarCleaner('Team')
+
+def multipart_body(parts):
+    chunks = []
+    for content_id, http_response in parts:
+        chunks.append(f'--{BOUNDARY}\r\nContent-Type: application/http\r\n')
+        if content_id is not None:
+            chunks.append(f'Content-ID: <{content_id}>\r\n')
+        chunks.append(f'\r\n{http_response}\r\n')
+    chunks.append(f'--{BOUNDARY}--\r\n')
+    return ''.join(chunks).encode()
+
+def batch_response(parts):
+    response = MagicMock()
+    response.status = 200
+    response.headers = CIMultiDict({'Content-Type': f'multipart/mixed; boundary={BOUNDARY}'})
+    content = aiohttp.StreamReader(MagicMock(), 2 ** 16, loop=asyncio.get_running_loop())
+    content.feed_data(multipart_body(parts))
+    content.feed_eof()
+    response.content = content
+    response.release = AsyncMock()
+    context = MagicMock()
+    context.__aenter__.return_value = response
+    return context
+
+def test_events_path_quotes_calendar_id(cleaner):
+    assert cleaner._events_path == '/calendar/v3/calendars/team%40group.calendar.google.com/events/'
+
+def test_delete_batch_parses_multipart_and_resends_throttled(cleaner, capsys):
+    session = MagicMock()
+
+    async def run():
+        session.post.side_effect = [
+            batch_response([
+                ('response-0', 'HTTP/1.1 204 No Content\r\n'),
+                ('response-1', 'HTTP/1.1 404 Not Found\r\nContent-Type: application/json\r\n\r\n{"error": "notFound"}'),
+                ('response-2', 'HTTP/1.1 429 Too Many Requests\r\nRetry-After: 0\r\n'),
+                (None, 'HTTP/1.1 204 No Content\r\n'),
+            ]),
+            batch_response([('response-0', 'HTTP/1.1 204 No Content\r\n')]),
+        ]
+        limiter = AdaptiveSemaphore(4)
+        await cleaner._delete_batch(session, ['e0', 'e1', 'e2', 'e3'], TokenBucket(100, 100), limiter)
+        return limiter
+
+    limiter = asyncio.run(run())
+
+    assert session.post.call_count == 2
+    first_body = session.post.call_args_list[0].kwargs['data']
+    retry_body = session.post.call_args_list[1].kwargs['data']
+    assert first_body.count('DELETE ') == 4
+    assert retry_body.count('DELETE ') == 1
+    assert f'DELETE {cleaner._events_path}e2 HTTP/1.1' in retry_body
+    output = capsys.readouterr().out
+    assert 'Could not delete event e1: 404' in output
+    assert 'Skipping unreadable batch response part' in output
+    assert 'Could not delete event e3: no response in batch' in output
+    assert 'e0' not in output and 'e2' not in output
+    assert limiter.limit == 2
@@ -0,0 +1,111 @@
+# test_http_utils.py
+import asyncio
+import sys
+from unittest.mock import patch, MagicMock
+from http_utils import AdaptiveSemaphore, TokenBucket, run
+
+def run_with_fake_clock(coro_factory):
+    clock = [0.0]
+    sleeps = []
+
+    async def fake_sleep(delay):
+        sleeps.append(delay)
+        clock[0] += delay
+
+    async def runner():
+        loop = asyncio.get_running_loop()
+        with patch.object(loop, 'time', lambda: clock[0]), \
+             patch('http_utils.asyncio.sleep', fake_sleep):
+            await coro_factory(clock)
+
+    asyncio.run(runner())
+    return sleeps
+
+def test_token_bucket_allows_burst_up_to_capacity():
+    async def scenario(clock):
+        bucket = TokenBucket(10, 5)
+        await bucket.acquire(4)
+        await bucket.acquire(6)
+
+    assert run_with_fake_clock(scenario) == []
+
+def test_token_bucket_waits_for_refill():
+    async def scenario(clock):
+        bucket = TokenBucket(10, 5)
+        await bucket.acquire(10)
+        await bucket.acquire(5)
+
+    assert run_with_fake_clock(scenario) == [1.0]
+
+def test_token_bucket_refills_with_elapsed_time_up_to_capacity():
+    async def scenario(clock):
+        bucket = TokenBucket(10, 5)
+        await bucket.acquire(10)
+        clock[0] += 1.0
+        await bucket.acquire(5)
+        clock[0] += 100.0
+        await bucket.acquire(10)
+        await bucket.acquire(1)
+
+    assert run_with_fake_clock(scenario) == [0.2]
+
+def test_adaptive_semaphore_halves_on_throttle_and_grows_after_successes():
+    async def scenario():
+        limiter = AdaptiveSemaphore(16)
+        limiter.throttled()
+        limiter.throttled()
+        assert limiter.limit == 4
+        for _ in range(10):
+            limiter.succeeded()
+        assert limiter.limit == 5
+        for _ in range(200):
+            limiter.succeeded()
+        assert limiter.limit == 16
+
+    asyncio.run(scenario())
+
+def test_adaptive_semaphore_caps_in_flight_at_current_limit():
+    in_flight = []
+    peak = []
+
+    async def task(limiter):
+        async with limiter:
+            in_flight.append(1)
+            peak.append(len(in_flight))
+            await asyncio.sleep(0)
+            in_flight.pop()
+
+    async def scenario():
+        limiter = AdaptiveSemaphore(8)
+        limiter.throttled()
+        limiter.throttled()
+        await asyncio.gather(*[task(limiter) for _ in range(20)])
+
+    asyncio.run(scenario())
+    assert max(peak) == 2
+
+def run_with_uvloop(platform, version_info):
+    uvloop = MagicMock()
+    coro = object()
+    with patch.dict(sys.modules, {'uvloop': uvloop}), \
+         patch('http_utils.sys') as fake_sys, \
+         patch('http_utils.asyncio.run') as asyncio_run:
+        fake_sys.platform = platform
+        fake_sys.version_info = version_info
+        run(coro)
+    return uvloop, asyncio_run, coro
+
+def test_run_uses_uvloop_loop_factory_on_python_312():
+    uvloop, asyncio_run, coro = run_with_uvloop('linux', (3, 12, 0))
+    asyncio_run.assert_called_once_with(coro, loop_factory=uvloop.new_event_loop)
+    uvloop.install.assert_not_called()
+
+def test_run_installs_uvloop_policy_before_python_312():
+    uvloop, asyncio_run, coro = run_with_uvloop('linux', (3, 11, 7))
+    uvloop.install.assert_called_once_with()
+    asyncio_run.assert_called_once_with(coro)
+
+def test_run_skips_uvloop_on_windows():
+    uvloop, asyncio_run, coro = run_with_uvloop('win32', (3, 12, 0))
+    uvloop.install.assert_not_called()
+    asyncio_run.assert_called_once_with(coro)